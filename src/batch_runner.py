@@ -0,0 +1,351 @@
+"""Resumable batch runs of eval and comp jobs, recorded in a SQLite job store."""
+
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+import zlib
+
+import pandas as pd
+
+import compare_sets
+import evaluate_bins
+import plasmid_comparison_main as pcm
+from log_errors_utils import (
+    CustomException,
+    check_file,
+    create_directory,
+    process_error,
+    process_warning,
+)
+from results_writer import ResultsWriter
+
+JOBS_COLUMNS = ["job_id", "mode", "input_1", "input_2"]
+PARAMS_COLUMNS = {"min_len": int, "p": float, "max_calls": int}
+OUT_EXTENSIONS = {"tsv": "out", "jsonl": "jsonl", "parquet": "parquet"}
+
+JOBS_TABLE = """CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    mode TEXT NOT NULL,
+    input_1 TEXT NOT NULL,
+    input_2 TEXT NOT NULL,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,
+    host TEXT,
+    start_time REAL,
+    end_time REAL,
+    runtime REAL,
+    n_calls INTEGER,
+    result TEXT,
+    error TEXT
+)"""
+
+
+def _json_default(value):
+    """Convert numpy scalars to Python builtins for JSON serialization."""
+    return value.item()
+
+
+def parse_shard(shard):
+    """Parse a shard 'i/N' into the pair (i, N), with 1 <= i <= N."""
+    try:
+        shard_idx, n_shards = (int(x) for x in shard.split("/"))
+    except ValueError:
+        process_error(f"Invalid shard {shard}: expected i/N")
+    if not 1 <= shard_idx <= n_shards:
+        process_error(f"Invalid shard {shard}: expected 1 <= i <= N")
+    return shard_idx, n_shards
+
+
+def job_shard(job_id, n_shards):
+    """Shard (1 to n_shards) of a job, stable across runs and machines."""
+    return zlib.crc32(job_id.encode()) % n_shards + 1
+
+
+def read_jobs(jobs_file, default_params):
+    """Read the jobs file.
+
+    Arguments
+    ---------
+    jobs_file: path to TSV file with columns job_id, mode (eval or comp),
+        input_1, input_2 (predicted and ground truth bins for eval, left and
+        right bins for comp) and optional columns min_len, p, max_calls
+    default_params: dictionary of parameters of the jobs, overridden by the
+        optional columns of the jobs file
+
+    Returns
+    -------
+    list of jobs (job_id, mode, input_1, input_2, params dictionary)
+    """
+    jobs_df = pd.read_csv(jobs_file, sep="\t", dtype={col: str for col in JOBS_COLUMNS})
+    for col in JOBS_COLUMNS:
+        if col not in jobs_df.columns:
+            process_error(f"{jobs_file}: missing column {col}")
+    if jobs_df["job_id"].duplicated().any():
+        process_error(f"{jobs_file}: duplicated job ids")
+    jobs = []
+    for _, row in jobs_df.iterrows():
+        if row["mode"] not in ["eval", "comp"]:
+            process_error(f"{jobs_file}: job {row['job_id']}: unknown mode {row['mode']}")
+        params = dict(default_params)
+        for col, col_type in PARAMS_COLUMNS.items():
+            if col in jobs_df.columns and pd.notna(row[col]):
+                params[col] = col_type(row[col])
+        jobs.append((row["job_id"], row["mode"], row["input_1"], row["input_2"], params))
+    return jobs
+
+
+def open_job_store(db_file):
+    """Open (and create if needed) the job store."""
+    conn = sqlite3.connect(db_file, timeout=60)
+    conn.execute(JOBS_TABLE)
+    conn.commit()
+    return conn
+
+
+def register_jobs(conn, jobs):
+    """Add new jobs to the job store as pending.
+
+    Jobs already in the store keep their status, unless their mode, inputs or
+    parameters changed, in which case they are reset to pending.
+    """
+    for job_id, mode, input_1, input_2, params in jobs:
+        params_json = json.dumps(params, sort_keys=True)
+        stored = conn.execute(
+            "SELECT mode, input_1, input_2, params FROM jobs WHERE job_id = ?",
+            (job_id,),
+        ).fetchone()
+        if stored is None:
+            conn.execute(
+                "INSERT INTO jobs (job_id, mode, input_1, input_2, params, status) VALUES (?, ?, ?, ?, ?, 'pending')",
+                (job_id, mode, input_1, input_2, params_json),
+            )
+        elif stored != (mode, input_1, input_2, params_json):
+            conn.execute(
+                "UPDATE jobs SET mode = ?, input_1 = ?, input_2 = ?, params = ?, status = 'pending',"
+                " host = NULL, start_time = NULL, end_time = NULL, runtime = NULL, n_calls = NULL,"
+                " result = NULL, error = NULL WHERE job_id = ?",
+                (mode, input_1, input_2, params_json, job_id),
+            )
+    conn.commit()
+
+
+def set_log_file(log_file):
+    """Send the log of the next job to log_file."""
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers[:]:
+        root_logger.removeHandler(handler)
+        handler.close()
+    if log_file is not None:
+        handler = logging.FileHandler(log_file, mode="w")
+        handler.setFormatter(logging.Formatter("%(name)s - %(levelname)s - %(message)s"))
+        root_logger.addHandler(handler)
+        root_logger.setLevel(logging.INFO)
+
+
+def run_job(mode, input_1, input_2, params, output_file, out_format, max_log_rows):
+    """Run one eval or comp job.
+
+    Returns
+    -------
+    dictionary of results (overall statistics for eval, dissimilarity or
+    bounds on it for comp), number of recursive calls (None for eval)
+
+    Raises
+    ------
+    CustomException if an input file is missing, compare_sets.SearchLimitException
+    (with the number of recursive calls made) if a comparison exceeds the
+    maximum number of recursive calls or its time budget
+    """
+    for in_file in [input_1, input_2]:
+        if not os.path.isfile(in_file):
+            raise CustomException(f"{in_file}: File is missing")
+    if mode == "eval":
+        writer = ResultsWriter(output_file, evaluate_bins.EVAL_COLUMNS, out_format=out_format)
+        try:
+            len_dict = {}
+            pred_dict, len_dict = evaluate_bins.get_bin_details(len_dict, input_1)
+            gt_dict, len_dict = evaluate_bins.get_bin_details(len_dict, input_2)
+            result = evaluate_bins.eval_bins(
+                pred_dict,
+                gt_dict,
+                len_dict,
+                params["min_len"],
+                writer,
+                max_log_rows,
+            )
+        finally:
+            writer.close()
+        return result, None
+    writer = ResultsWriter(
+        output_file,
+        compare_sets.COMP_COLUMNS,
+        out_format=out_format,
+        header=False,
+    )
+    try:
+        result = pcm.compare_sample(
+            input_1,
+            input_2,
+            params["p"],
+            params["min_len"],
+            params["max_calls"],
+            writer,
+            max_log_rows=max_log_rows,
+            time_budget=params["time_budget"],
+            bounds_threshold=params["bounds_threshold"],
+        )
+    finally:
+        writer.close()
+    return result, result.get("n_calls")
+
+
+def run_batch(
+    jobs_file,
+    db_file,
+    out_dir,
+    shard="1/1",
+    min_len=0,
+    p=0.5,
+    max_calls=10000000,
+    time_budget=None,
+    bounds_threshold=None,
+    retry_failed=False,
+    out_format="tsv",
+    max_log_rows=None,
+):
+    """Run the jobs of a shard, recording them in the job store.
+
+    Jobs already done (or failed, unless retry_failed) in the job store are
+    skipped, so an interrupted run is resumed by running it again. The output
+    and log files of a job are written in out_dir, named after its job id.
+
+    Arguments
+    ---------
+    jobs_file: see read_jobs
+    db_file: path to SQLite job store
+    out_dir: path to output directory
+    shard: 'i/N', only the jobs of shard i out of N are run
+    min_len, p, max_calls: default parameters of the jobs
+    time_budget: maximum time (in seconds) of the branch-and-bound of comp jobs
+    bounds_threshold: threshold on the normalized dissimilarity, comp jobs
+        whose bounds decide it are not searched (see pcm.compare_sample)
+    retry_failed (bool): run again the jobs that failed
+    out_format, max_log_rows: see ResultsWriter and eval_mode/comp_mode
+    """
+    check_file(jobs_file)
+    create_directory([out_dir, os.path.dirname(db_file)])
+    shard_idx, n_shards = parse_shard(shard)
+    default_params = {
+        "min_len": min_len,
+        "p": p,
+        "max_calls": max_calls,
+        "time_budget": time_budget,
+        "bounds_threshold": bounds_threshold,
+    }
+    jobs = [
+        job
+        for job in read_jobs(jobs_file, default_params)
+        if job_shard(job[0], n_shards) == shard_idx
+    ]
+    conn = open_job_store(db_file)
+    register_jobs(conn, jobs)
+    host = socket.gethostname()
+    n_status = {"done": 0, "failed": 0, "skipped": 0}
+    for job_id, mode, input_1, input_2, params in jobs:
+        (status,) = conn.execute(
+            "SELECT status FROM jobs WHERE job_id = ?",
+            (job_id,),
+        ).fetchone()
+        if status == "done" or (status == "failed" and not retry_failed):
+            n_status["skipped"] += 1
+            continue
+        start_time = time.time()
+        conn.execute(
+            "UPDATE jobs SET status = 'running', host = ?, start_time = ?, end_time = NULL, runtime = NULL,"
+            " n_calls = NULL, result = NULL, error = NULL WHERE job_id = ?",
+            (host, start_time, job_id),
+        )
+        conn.commit()
+        set_log_file(os.path.join(out_dir, f"{job_id}.log"))
+        output_file = os.path.join(out_dir, f"{job_id}.{OUT_EXTENSIONS[out_format]}")
+        result, n_calls, error = None, None, None
+        try:
+            result, n_calls = run_job(
+                mode,
+                input_1,
+                input_2,
+                params,
+                output_file,
+                out_format,
+                max_log_rows,
+            )
+            status = "done"
+        except (Exception, SystemExit) as e:
+            # process_error and process_exception exit the interpreter
+            status, error = "failed", str(e) or type(e).__name__
+            if isinstance(e, compare_sets.SearchLimitException):
+                n_calls = e.n_calls
+            process_warning(f"Job {job_id} failed: {error}")
+        end_time = time.time()
+        conn.execute(
+            "UPDATE jobs SET status = ?, end_time = ?, runtime = ?, n_calls = ?, result = ?, error = ? WHERE job_id = ?",
+            (
+                status,
+                end_time,
+                end_time - start_time,
+                n_calls,
+                None if result is None else json.dumps(result, default=_json_default),
+                error,
+                job_id,
+            ),
+        )
+        conn.commit()
+        n_status[status] += 1
+    set_log_file(None)
+    conn.close()
+    print(
+        f"Shard {shard_idx}/{n_shards}: {len(jobs)} jobs, {n_status['done']} done, "
+        f"{n_status['failed']} failed, {n_status['skipped']} skipped",
+    )
+
+
+def summary_mode(db_files, n_slowest=10):
+    """Print the status counts, throughput and slowest jobs of job stores.
+
+    Arguments
+    ---------
+    db_files: list of paths to SQLite job stores (e.g. one per shard)
+    n_slowest: number of slowest jobs to report
+    """
+    jobs_dfs = []
+    for db_file in db_files:
+        check_file(db_file)
+        with sqlite3.connect(db_file, timeout=60) as conn:
+            jobs_dfs.append(
+                pd.read_sql_query(
+                    "SELECT job_id, mode, status, host, start_time, end_time, runtime, n_calls, error FROM jobs",
+                    conn,
+                ),
+            )
+    jobs_df = pd.concat(jobs_dfs, ignore_index=True)
+    print("#Status\tMode\tJobs")
+    for (status, mode), n_jobs in jobs_df.groupby(["status", "mode"]).size().items():
+        print(f"{status}\t{mode}\t{n_jobs}")
+    finished_df = jobs_df[jobs_df["status"].isin(["done", "failed"])]
+    if len(finished_df) == 0:
+        return
+    wall_time = finished_df["end_time"].max() - finished_df["start_time"].min()
+    print("#Throughput")
+    print(f"Finished_jobs\t{len(finished_df)}")
+    print(f"Wall_time\t{wall_time}")
+    print(f"Total_runtime\t{finished_df['runtime'].sum()}")
+    print(f"Mean_runtime\t{finished_df['runtime'].mean()}")
+    if wall_time > 0:
+        print(f"Jobs_per_hour\t{3600 * len(finished_df) / wall_time}")
+    print("#Job_id\tMode\tStatus\tHost\tRuntime\tN_calls")
+    for _, row in finished_df.nlargest(n_slowest, "runtime").iterrows():
+        n_calls = None if pd.isna(row["n_calls"]) else int(row["n_calls"])
+        print(f"{row['job_id']}\t{row['mode']}\t{row['status']}\t{row['host']}\t{row['runtime']}\t{n_calls}")
@@ -1,33 +1,40 @@
 import networkx as nx
 import itertools
 from collections import defaultdict
-import copy
+from array import array
 from math import factorial
 
 import logging
 import psutil
 import time
-import sys
+
+from log_errors_utils import CustomException, log_rows
+from state_store import digest
 
 logger = logging.getLogger(__name__)
 
+COMP_COLUMNS = [('Statistic', 'str'), ('Value', 'float'), ('Normalized', 'float')]
+
+class SearchLimitException(CustomException):
+	'''
+	Raised when the branch-and-bound exceeds the maximum number of recursive calls or the time budget,
+	n_calls: number of recursive calls made before stopping
+	'''
+	def __init__(self, msg, n_calls):
+		super().__init__(msg)
+		self.n_calls = n_calls
+
 def generate_matchings(m, n):
 	'''
 	Input: Number of copies of a contig in left and right plasmid sets
-	Returns: List of matchings where each matching is a pair of lists of indices (int) of the contig copies, one for each side.
+	Returns: Iterator over the matchings, generated lazily, where each matching is a pair of tuples of indices (int) of the contig copies, one for each side.
 	'''
-	matchings = []
 	if m >= n:
-		pmutns = list(itertools.permutations(list(range(m)), n))
-		n_list = list(range(n))
-		for pmutn in pmutns:
-			matchings.append((list(pmutn), n_list))
+		n_tuple = tuple(range(n))
+		return ((pmutn, n_tuple) for pmutn in itertools.permutations(range(m), n))
 	else:
-		pmutns = list(itertools.permutations(list(range(n)), m))
-		m_list = list(range(m))
-		for pmutn in pmutns:
-			matchings.append((m_list, list(pmutn)))
-	return matchings
+		m_tuple = tuple(range(m))
+		return ((m_tuple, pmutn) for pmutn in itertools.permutations(range(n), m))
 
 def get_matching_positions(ctg_copies, matching):
 	'''
@@ -35,7 +42,7 @@ def get_matching_positions(ctg_copies, matching):
 		Dictionary of contig copies: L_copies: list of contig copies in left plasmid
 									 R_copies: list of contig copies in right plasmid
 									 Each copy is a triple [contig, plasmid index (int), position in plasmid (int)]
-		Matching: Pair of lists of indices (int) of the contig copies, one for each side
+		Matching: Pair of tuples of indices (int) of the contig copies, one for each side
 	Returns: Pair of lists of contig copies, one for each side, according to respective indices in the matching 
 	'''	
 	L, R = ctg_copies['L_copies'], ctg_copies['R_copies']
@@ -46,204 +53,357 @@ def get_matching_positions(ctg_copies, matching):
 		r_posn.append(R[x])	
 	return l_posn, r_posn
 
-def rename_by_matching(matching_dict):
+def encode_contigs(contig_list, contigs_dict):
 	'''
-	Input: 
-		Dictionary of matchings: Key: contig, 
-								 Value: matching for copies of contig
-								 Each matching is pair of lists of indices (int) of the contig copies, one for each side
+	Input:
+		List of contigs (str), in the order in which they are matched (one contig per level of the search)
+		Dictionary of contigs: Key: contig (str), Value: Nested dictionary: length (int), 
+																			L_copies/R_copies (list of contig copies in plasmid set)
 	Returns:
-	 	Two lists of contig copies, one for each plasmid set, renamed with indices according to the input matching 
-		Each contig is a triple [contig, plasmid index (int), position in plasmid (int)]
-	'''
-	reached_contigs = matching_dict.keys()
-	left_copies_renamed, right_copies_renamed = [], []
-	for contig in reached_contigs:
-		M = matching_dict[contig]
-		left_ctgs = M[0]
-		right_ctgs = M[1]
-		for i in range(len(M[0])):
-			lpls, lidx = left_ctgs[i][1], left_ctgs[i][2]
-			left_copies_renamed.append([contig+'_'+str(i), lpls, lidx])
-			rpls, ridx = right_ctgs[i][1], right_ctgs[i][2]
-			right_copies_renamed.append([contig+'_'+str(i), rpls, ridx])
-	return left_copies_renamed, right_copies_renamed
-
-def add_nodes(G, left_ctg_list, right_ctg_list, pls_ids_dict):
+		Dictionary of integer-coded contigs:
+			copies: List with, for each contig of the list, a pair of tuples of plasmid indices (int) of the contig copies, one for each side
+			ctg_len: Array of lengths of the contigs of the list
+	'''
+	copies, ctg_len = [], array('d')
+	for contig in contig_list:
+		L, R = contigs_dict[contig]['L_copies'], contigs_dict[contig]['R_copies']
+		copies.append((tuple(x[1] for x in L), tuple(x[1] for x in R)))
+		ctg_len.append(contigs_dict[contig]['length'])
+	return {'copies': copies, 'ctg_len': ctg_len}
+
+def decode_matching(contig_list, contigs_dict, choices):
 	'''
 	Input:
-		Empty graph object G
-		List of contig copies in left plasmid set
-		List of contig copies in right plasmid set
-		Dictionary of plasmids: Keys: L, R, Values: Bidict of plasmid indices <-> names/ids
+		List of contigs (str), in the order in which they are matched
+		Dictionary of contigs
+		Sequence of the matchings chosen for each contig (see generate_matchings)
 	Returns:
-		Bipartite graph G (no edges added yet)
+		Dictionary of matchings: Key: contig, Value: pair of lists of matched contig copies, one for each side
 	'''
-	G.add_nodes_from(list(set([pls_ids_dict['L'].inv[x[1]] for x in left_ctg_list])), bipartite=0)
-	G.add_nodes_from(list(set([pls_ids_dict['R'].inv[x[1]] for x in right_ctg_list])), bipartite=1)
-	return G
+	matching_dict = {}
+	for k, choice in enumerate(choices):
+		contig = contig_list[k]
+		matching_dict[contig] = get_matching_positions(contigs_dict[contig], choice)
+	return matching_dict
 
-def add_edges(G, left_ctg_list, right_ctg_list, pls_ids_dict):
+def compute_pairs_cost(pair_len, p, pls_ids=(None, None)):
 	'''
 	Input:
-		Graph object G with vertices added
-		List of contig copies in left plasmid set
-		List of contig copies in right plasmid set
-		Dictionary of plasmids: Keys: L, R, Values: Bidict of plasmid indices <-> names/ids
+		Dictionary of matched contig copies: Key: pair of left and right plasmid indices (int),
+											 Value: total length of the matched copies shared by the pair of plasmids
+		Pair of sets of left and right plasmid indices whose splits are accounted for (all plasmids if None)
 	Returns:
-		Bipartite graph G (with edges added)
-	'''	
-	def list_ctg_ids_by_pls(pls_ids_dict_one_side, ctg_ids_list):
-		'''
-		Input:
-			Bidict of plasmid indices <-> names/ids,
-			List of contig copies
-		Returns: 
-			Dictionary: Key: plasmid id, 
-						Value: List of contig ids in the plasmid from given contig list
-		'''
-		ctg_ids_by_pls = defaultdict(list)
-		for ctg in ctg_ids_list:
-			ctg_id, pls_id = ctg[0], pls_ids_dict_one_side.inv[ctg[1]]
-			ctg_ids_by_pls[pls_id].append(ctg_id)
-		return ctg_ids_by_pls
-	left_ctg_ids_by_pls = list_ctg_ids_by_pls(pls_ids_dict['L'], left_ctg_list)
-	right_ctg_ids_by_pls = list_ctg_ids_by_pls(pls_ids_dict['R'], right_ctg_list)
-	
-	edges_list = []
-	for left_plasmid in left_ctg_ids_by_pls:
-		for right_plasmid in right_ctg_ids_by_pls:
-			left_keys = set(left_ctg_ids_by_pls[left_plasmid])
-			right_keys = set(right_ctg_ids_by_pls[right_plasmid])
-			if left_keys.intersection(right_keys) != set():
-				edges_list.append((left_plasmid, right_plasmid))
-	G.add_edges_from(edges_list)
-	return G
-
-def modify_partitions(partitions, common):
+		Cost of cuts (left side splits) and joins (right side splits)
+	The partition of a plasmid induced by a matching groups its matched copies by the plasmid of their copy on the opposite side,
+	so each part of a plasmid is a pair of plasmids, and the cost of a plasmid is the total of (length of parts)^p but the largest one
+	'''
+	part_costs = [defaultdict(list), defaultdict(list)]		#Costs of the parts of the left (resp. right) plasmids
+	for pair, S_len in pair_len.items():
+		if S_len != 0:
+			S_cost = S_len**p
+			for flag in [0, 1]:
+				if pls_ids[flag] is None or pair[flag] in pls_ids[flag]:
+					part_costs[flag][pair[flag]].append(S_cost)
+	cuts_cost, joins_cost = [sum(sum(costs) - max(costs) for costs in side_costs.values()) for side_costs in part_costs]
+	return cuts_cost, joins_cost
+
+def get_single_copy_pairs(contig_list, contigs_dict):
 	'''
 	Input:
-		partitions: List of sets of contigs
-		common: Set of contigs common to both plasmids 	
+		List of contigs (str) with a single copy in each plasmid set
+		Dictionary of contigs
 	Returns:
-		list of partitions, modified by splitting each partition if required, according to the set of common contigs
+		Dictionary of the matched copies of the contigs by pair of plasmids (see compute_pairs_cost)
+		Dictionary of the (unique) matching of the copies of the contigs (see decode_matching)
 	'''
-	modified_partitions = []
-	for S in partitions:
-		if len(S.intersection(common)) != 0 or S.intersection(common) != S:
-			modified_partitions.append(S.intersection(common))
-			modified_partitions.append(S.difference(common))
-		elif S.intersection(common) == S:
-			modified_partitions.append(S)	
-	return modified_partitions		
+	pair_len = defaultdict(int)
+	matching_dict = {}
+	for contig in contig_list:
+		l_copy, r_copy = contigs_dict[contig]['L_copies'][0], contigs_dict[contig]['R_copies'][0]
+		pair_len[(l_copy[1], r_copy[1])] += contigs_dict[contig]['length']
+		matching_dict[contig] = ([l_copy], [r_copy])
+	return pair_len, matching_dict
 
-def get_partition_cost(partitions, contigs_dict, p):
+def compute_current_cost(ctg_codes, choices, depth, p, fixed_pair_len=None, pls_ids=(None, None)):
 	'''
 	Input:
-		partitions: List of sets of contigs
-		contigs_dict: Key: contig (str), Value: Nested dictionary: 	length (int), 
-																	L_copies/R_copies (list of contig copies in plasmid set)
+		Dictionary of integer-coded contigs (see encode_contigs),
+		Sequence of the matchings chosen for each contig (see generate_matchings) and number of contigs matched so far,
+		Dictionary of matched copies by pair of plasmids of contigs whose matching is fixed (see compute_pairs_cost, none if None)
+		Pair of sets of left and right plasmid indices whose splits are accounted for (all plasmids if None)
 	Returns:
-		Total of (length of contig sets)^p and the cost of partitioning
-	'''	
-	total_len = 0
-	largest_part_cost = 0
-	for S in partitions:
-		S_len = 0
-		for contig in S:
-			contig_len = contigs_dict[contig.split('_')[0]]['length']
-			S_len += contig_len
-		if S_len != 0:
-			S_cost = S_len**p
-			total_len += S_cost
-			largest_part_cost = max(largest_part_cost, S_cost)
-	cost = total_len - largest_part_cost
-	return total_len, cost
+		Cost of cuts and joins of current matching
+	'''
+	copies, ctg_len = ctg_codes['copies'], ctg_codes['ctg_len']
+	pair_len = {} if fixed_pair_len is None else dict(fixed_pair_len)
+	for k in range(depth):
+		l_pls, r_pls = copies[k]
+		l_idx, r_idx = choices[k]
+		for i in range(len(l_idx)):
+			pair = (l_pls[l_idx[i]], r_pls[r_idx[i]])
+			pair_len[pair] = pair_len.get(pair, 0) + ctg_len[k]
+	return compute_pairs_cost(pair_len, p, pls_ids)
 
-def compute_splits_cost(pls_ids, side_contig_copies, opp_contig_copies, B, flag, pls_ids_dict, contigs_dict, p):
+def compute_unmatched_costs(contigs_dict, p):
 	'''
 	Input:
-		pls_ids: List of plasmid ids,
-		side_contig_copies: list of contig copies in plasmid set
-		opp_contig_copies: list of contig copies in opposite plasmid set
-		B: bipartite graph object
-		flag (binary): variable to indicate if side is left (0) or right (1)
-		Dictionaries of plasmids and contigs
+		Dictionary of contigs: Key: contig (str), Value: Nested dictionary: length (int), 
+																			L_copies/R_copies (list of contig copies in plasmid set)
 	Returns:
-		Total cost of splits (cuts OR joins) for one plasmid set
+		Total length of contig copies, total cost of contig copies (normalization denominator),
+		cost of contig copies present only in left (extra) and only in right (missing) plasmid sets
 	'''
-	def get_ctg_list_by_pls(contig_copies, pls_ids_dict, side):
+	total_len, total_denom, unique_left_cost, unique_right_cost = 0, 0, 0, 0
+	for c in contigs_dict:
+		l_copies, r_copies = len(contigs_dict[c]['L_copies']), len(contigs_dict[c]['R_copies'])
+		ctg_len = contigs_dict[c]['length']
+		unique_left_cost += max(l_copies - r_copies, 0) * (ctg_len**p)
+		unique_right_cost += max(r_copies - l_copies, 0) * (ctg_len**p)
+		total_len += (l_copies + r_copies) * ctg_len
+		total_denom += (l_copies + r_copies) * (ctg_len**p)
+	return total_len, total_denom, unique_left_cost, unique_right_cost
+
+def compute_bounds(contigs_dict, pls_ids_dict, p):
+	'''
+	Input:
+		Dictionary of contigs: Key: contig (str), Value: Nested dictionary: length (int), 
+																			L_copies/R_copies (list of contig copies in plasmid set)
+		Dictionary of plasmids: Keys: side (L/R), Values: Bidict of plasmid indices <-> names/ids
+	Returns:
+		Dictionary with the total length and cost of contig copies, the extra and missing contigs costs
+		and a lower and upper bound on the dissimilarity, computed without branching:
+			lower: cuts and joins induced by contigs with a single copy on each side (their matching is forced),
+				   as adding matched copies can only refine the partitions of the bins
+			upper: cuts and joins of the matching pairing the i-th left copy with the i-th right copy of each contig
+	'''
+	total_len, total_denom, unique_left_cost, unique_right_cost = compute_unmatched_costs(contigs_dict, p)
+	forced_contigs, repeated_contigs = [], []
+	for contig in contigs_dict:
+		m = len(contigs_dict[contig]['L_copies'])
+		n = len(contigs_dict[contig]['R_copies'])
+		if m == 1 and n == 1:
+			forced_contigs.append(contig)
+		elif m >= 1 and n >= 1:
+			repeated_contigs.append(contig)
+	forced_pair_len, _ = get_single_copy_pairs(forced_contigs, contigs_dict)
+	lower_cuts, lower_joins = compute_pairs_cost(forced_pair_len, p)
+	if len(repeated_contigs) == 0:
+		upper_cuts, upper_joins = lower_cuts, lower_joins
+	else:
+		#Matching pairing the i-th left copy with the i-th right copy of each contig, built directly (not enumerated)
+		ctg_codes = encode_contigs(repeated_contigs, contigs_dict)
+		choices = [(tuple(range(min(len(L), len(R)))), tuple(range(min(len(L), len(R))))) for (L, R) in ctg_codes['copies']]
+		upper_cuts, upper_joins = compute_current_cost(ctg_codes, choices, len(choices), p, forced_pair_len)
+	unmatched_cost = unique_left_cost + unique_right_cost
+	if total_denom == 0.0: total_denom = 1.0
+	return {
+		'total_len': total_len, 'total_denom': total_denom,
+		'extra_cost': unique_left_cost, 'missing_cost': unique_right_cost,
+		'lower': unmatched_cost + lower_cuts + lower_joins,
+		'upper': unmatched_cost + upper_cuts + upper_joins,
+		'lower_norm': (unmatched_cost + lower_cuts + lower_joins) / total_denom,
+		'upper_norm': (unmatched_cost + upper_cuts + upper_joins) / total_denom
+	}
+
+def bounds_decide(bounds, threshold):
+	'''
+	Input:
+		Dictionary of bounds on the dissimilarity (see compute_bounds)
+		Threshold on the normalized dissimilarity
+	Returns:
+		True if the bounds are equal (exact dissimilarity) or both on the same side of the threshold
+	'''
+	return bounds['lower'] == bounds['upper'] or bounds['lower_norm'] >= threshold or bounds['upper_norm'] < threshold
+
+def run_compare_bounds(contigs_dict, pls_ids_dict, p, results_writer, bounds=None):
+	'''
+	Input:
+		Dictionaries of contigs and plasmids (see run_compare_plasmids)
+		Results writer (see results_writer.ResultsWriter), with columns COMP_COLUMNS
+		Dictionary of bounds on the dissimilarity if already computed (see compute_bounds)
+	Returns:
+		Dictionary of bounds on the dissimilarity (see compute_bounds), also written with the results writer
+	'''
+	if bounds is None:
+		bounds = compute_bounds(contigs_dict, pls_ids_dict, p)
+	logger.info(f'Dissimilarity lower bound: {bounds["lower"]}\t{bounds["lower_norm"]}')
+	logger.info(f'Dissimilarity upper bound: {bounds["upper"]}\t{bounds["upper_norm"]}')
+	total_denom = bounds['total_denom']
+	results_writer.write({'Statistic': 'Total_ctg_length', 'Value': bounds['total_len']})
+	results_writer.write({'Statistic': 'Total_ctg_length_alpha', 'Value': total_denom})
+	for stat, cost in [('Extra_ctgs', bounds['extra_cost']), ('Missing_ctgs', bounds['missing_cost']),
+					   ('Dissimilarity_lower_bound', bounds['lower']), ('Dissimilarity_upper_bound', bounds['upper'])]:
+		results_writer.write({'Statistic': stat, 'Value': cost, 'Normalized': cost/total_denom})
+	return bounds
+
+def search_min_matching(contig_list, contigs_dict, pls_ids_dict, p, max_calls, count, start_time, time_budget=None):
+	'''
+	Input:
+		List of contigs (str) with copies in both plasmid sets, whose copies are matched
+		Dictionaries of contigs and plasmids (see run_compare_plasmids)
+		Maximum number of recursive calls, single-element list counting the recursive calls (updated)
+		Start time and maximum time (in seconds, no limit if None) of the branch-and-bound
+	Raises:
+		SearchLimitException if the number of recursive calls exceeds max_calls or the time budget is exceeded
+	Returns:
+		Cost of cuts and joins of the minimum cost matching of the copies of the contigs
+		Dictionary of the minimum cost matching (see decode_matching)
+	The matching of contigs with a single copy in each plasmid set is forced: the branch-and-bound only branches on the
+	repeated contigs, and only recomputes the splits of the plasmids with copies of repeated contigs
+	'''
+	#Computing upperbound on final_cost
+	max_cost = 0
+	n_matchings = {}
+	forced_contigs, repeated_contigs = [], []
+	for contig in contig_list:
+		m = len(contigs_dict[contig]['L_copies'])
+		n = len(contigs_dict[contig]['R_copies'])
+		max_cost += m * contigs_dict[contig]['length']
+		max_cost += n * contigs_dict[contig]['length']	
+		n_matchings[contig] = int(factorial(n)/factorial(n-m)) if n > m else int(factorial(m)/factorial(m-n))
+		if m == 1 and n == 1:
+			forced_contigs.append(contig)
+		else:
+			repeated_contigs.append(contig)
+
+	#Splits of the plasmids without copies of repeated contigs are fixed by the forced contigs
+	fixed_pair_len, forced_matching = get_single_copy_pairs(forced_contigs, contigs_dict)
+	repeated_pls = (set(x[1] for ctg in repeated_contigs for x in contigs_dict[ctg]['L_copies']),
+					set(x[1] for ctg in repeated_contigs for x in contigs_dict[ctg]['R_copies']))
+	other_pls = tuple(set(pair[flag] for pair in fixed_pair_len) - repeated_pls[flag] for flag in [0, 1])
+	fixed_cuts, fixed_joins = compute_pairs_cost(fixed_pair_len, p, other_pls)
+	repeated_pair_len = {pair: S_len for pair, S_len in fixed_pair_len.items() if pair[0] in repeated_pls[0] or pair[1] in repeated_pls[1]}
+
+	### Branch-N-Bound ###
+	sorted_contig_list = sorted(repeated_contigs, key=lambda ctg: n_matchings[ctg])
+	ctg_codes = encode_contigs(sorted_contig_list, contigs_dict)
+	n_levels = len(sorted_contig_list)
+
+	cuts_cost, joins_cost = compute_pairs_cost(repeated_pair_len, p, repeated_pls)
+	current_state = {'level': 0, 'total_cost': fixed_cuts + fixed_joins + cuts_cost + joins_cost, 'choices': [None] * n_levels, 
+					 'cuts_cost': fixed_cuts + cuts_cost, 'joins_cost': fixed_joins + joins_cost}
+	final_state = {'total_cost': max_cost, 'choices': [], 'cuts_cost': 0, 'joins_cost': 0}
+
+	def recursive_compare(current_state, count):
 		'''
-		Returns list of contigs for each plasmid
+		Input:
+			Current state dictionary: 
+				level: Distance from root of tree (int)
+				total_cost: Cost of cuts and joins upto this level (int)
+				choices: List of the matchings chosen for the contig of each level, valid upto this level
+						 (the matchings of a level are generated lazily, see generate_matchings)
+				cuts_cost, joins_cost: Cost of cuts, joins (respectively) upto this level (int)		
+		Updates:
+			Current state dictionary
+			Final state dictionary (non local variable)
 		'''
-		ctgs_by_pls = {}
-		for x in contig_copies:
-			ctg, pls = x[0], pls_ids_dict[side].inv[x[1]]
-			if pls not in ctgs_by_pls:
-				ctgs_by_pls[pls] = []
-			ctgs_by_pls[pls].append(ctg)
-		return ctgs_by_pls
-	[s, o] = ['L', 'R'] if flag == 0 else ['R', 'L']
-	side_ctgs_by_pls = get_ctg_list_by_pls(side_contig_copies, pls_ids_dict, s)
-	opp_ctgs_by_pls = get_ctg_list_by_pls(opp_contig_copies, pls_ids_dict, o)
-
-	side_len, side_cost = 0, 0
-	for node in pls_ids:
-		partitions = [set(side_ctgs_by_pls[node])]
-		for edge in B.edges:
-			if edge[flag] == node:
-				side_contigs, opp_contigs = set(side_ctgs_by_pls[edge[flag]]), set(opp_ctgs_by_pls[edge[1-flag]])
-				common = side_contigs.intersection(opp_contigs)
-				partitions = modify_partitions(partitions, common)
-		node_len, cost = get_partition_cost(partitions,contigs_dict,p)
-		side_len += node_len
-		side_cost += cost
-	return side_cost
-
-def compute_match_cost(left_contig_copies, right_contig_copies, pls_ids_dict, contigs_dict, p):
+		nonlocal final_state
+		level = current_state['level']
+		if level < n_levels:				#Compute cost upto current level
+			choices = current_state['choices']
+			l_copies, r_copies = ctg_codes['copies'][level]
+			for choice in generate_matchings(len(l_copies), len(r_copies)):
+				choices[level] = choice
+				count[0] += 1
+
+				if count[0] > max_calls:
+					logger.info(f'Max number of iterations reached: {max_calls}'); raise SearchLimitException(f'Max number of iterations reached: {max_calls}', count[0])
+				if time_budget is not None and time.time() - start_time > time_budget:
+					logger.info(f'Time budget exceeded: {time_budget}'); raise SearchLimitException(f'Time budget exceeded: {time_budget}', count[0])
+				cuts_cost, joins_cost = compute_current_cost(ctg_codes, choices, level + 1, p, repeated_pair_len, repeated_pls)
+				current_state['cuts_cost'], current_state['joins_cost'] = fixed_cuts + cuts_cost, fixed_joins + joins_cost
+				current_state['total_cost'] = current_state['cuts_cost'] + current_state['joins_cost']
+				if current_state['total_cost'] < final_state['total_cost']:	
+					current_state['level'] += 1 
+					recursive_compare(current_state, count)
+					current_state['level'] -= 1
+
+		else:
+			final_state['total_cost'] = current_state['total_cost']
+			final_state['cuts_cost'], final_state['joins_cost'] = current_state['cuts_cost'], current_state['joins_cost']
+			final_state['choices'] = list(current_state['choices'])
+	recursive_compare(current_state, count)
+	final_matching = forced_matching
+	final_matching.update(decode_matching(sorted_contig_list, contigs_dict, final_state['choices']))
+	return final_state['cuts_cost'], final_state['joins_cost'], final_matching
+
+def get_common_contigs(contigs_dict):
+	'''
+	Input: Dictionary of contigs (see run_compare_plasmids)
+	Returns: Set of contigs with copies in both plasmid sets
+	'''
+	left_ctg_ids = set([ctg for ctg in contigs_dict.keys() if len(contigs_dict[ctg]['L_copies']) >= 1])
+	right_ctg_ids = set([ctg for ctg in contigs_dict.keys() if len(contigs_dict[ctg]['R_copies']) >= 1])
+	return left_ctg_ids.intersection(right_ctg_ids)
+
+def get_blocks(contigs_dict, common_contigs):
 	'''
 	Input:
-		List of contig copies, one for each side
-		Dictionaries of plasmids and contigs
+		Dictionary of contigs (see run_compare_plasmids)
+		Set of contigs with copies in both plasmid sets
 	Returns:
-		Cost of cuts (left side splits) and joins (right side splits)
+		List of blocks, each a sorted list of common contigs
+		The copies of the contigs of a block belong to plasmids connected by common contigs,
+		so the cost of cuts and joins is the sum over blocks of the cost of matching the contigs of each block
+	'''
+	G = nx.Graph()
+	for contig in common_contigs:
+		copies = [('L', x[1]) for x in contigs_dict[contig]['L_copies']] + [('R', x[1]) for x in contigs_dict[contig]['R_copies']]
+		G.add_edges_from((copies[0], pls) for pls in copies)
+	block_of_pls = {}
+	for i, component in enumerate(nx.connected_components(G)):
+		for pls in component:
+			block_of_pls[pls] = i
+	blocks = defaultdict(list)
+	for contig in sorted(common_contigs):
+		blocks[block_of_pls[('L', contigs_dict[contig]['L_copies'][0][1])]].append(contig)
+	return [blocks[i] for i in sorted(blocks)]
+
+def get_block_signature(block, contigs_dict, pls_ids_dict, p):
+	'''
+	Input:
+		Block (list of contigs, see get_blocks)
+		Dictionaries of contigs and plasmids (see run_compare_plasmids)
+	Returns:
+		Signature of the block: digest of the weight exponent and, for each plasmid of the block, its name and the sorted
+		triples (contig, length, position in plasmid) of the copies of the contigs of the block
 	'''
-	B = nx.Graph()	#Create graph with vertices named according to matching and obtain connected components
-	B = add_nodes(B, left_contig_copies, right_contig_copies, pls_ids_dict)
-	B = add_edges(B, left_contig_copies, right_contig_copies, pls_ids_dict)
-	A = [B.subgraph(c) for c in nx.connected_components(B)]
-	left_pls_set = set([pls_ids_dict['L'].inv[x[1]] for x in left_contig_copies])
-	n_conn_comp = len(list(A))
-	left_splits_cost,right_splits_cost = 0, 0
-	for i in range(n_conn_comp):
-		C = list(A)[i]
-		left_pls_ids, right_pls_ids = nx.bipartite.sets(C)		#Split the component according to bipartite sets
-		if len(list(right_pls_ids)) != 0 and list(right_pls_ids)[0] in left_pls_set: 	#Ensuring proper assignments of bipartite parts
-			right_pls_ids,left_pls_ids = left_pls_ids,right_pls_ids
-		left_splits_cost += compute_splits_cost(left_pls_ids, left_contig_copies, right_contig_copies, B, 0, pls_ids_dict, contigs_dict, p)
-		right_splits_cost += compute_splits_cost(right_pls_ids, right_contig_copies, left_contig_copies, B, 1, pls_ids_dict, contigs_dict, p)
-
-	return left_splits_cost, right_splits_cost	
-
-def compute_current_cost(matching_dict, pls_ids_dict, contigs_dict, p):
+	pls_copies = defaultdict(list)
+	for contig in block:
+		ctg_len = int(contigs_dict[contig]['length'])
+		for side in ['L', 'R']:
+			for x in contigs_dict[contig][f'{side}_copies']:
+				pls_copies[pls_ids_dict[side].inv[x[1]]].append((contig, ctg_len, int(x[2])))
+	return digest((p, sorted((pls, sorted(pls_copies[pls])) for pls in pls_copies)))
+
+def write_comparison(contigs_dict, p, cuts_cost, joins_cost, final_matching, n_calls, results_writer, max_log_rows=None):
 	'''
 	Input:
-		Dictionary of matchings: Key: contig, Value: matching for copies of contig,
-		Dictionary of plasmids: Keys: side (L/R), Values: Bidict of plasmid indices <-> names/ids
-		Dictionary of contigs: Key: contig (str), Value: Nested dictionary: length (int), 
-																			L_copies/R_copies (list of contig copies in plasmid set)
+		Dictionary of contigs (see run_compare_plasmids)
+		Cost of cuts and joins of the minimum cost matching, dictionary of the matching (see decode_matching)
+		Number of recursive calls
+		Results writer (see results_writer.ResultsWriter), with columns COMP_COLUMNS
+		Maximum number of rows of the matching to log (all if None)
+	Writes:
+		Dissimilarity score and associated costs (cuts, joins, contig copies present on only left or right plasmid sets)
 	Returns:
-		Cost of current matching
-	'''	
-	left_contig_copies, right_contig_copies = rename_by_matching(matching_dict)
-	left_ctg_ids, right_ctg_ids = set(), set()
-	for x in left_contig_copies:
-		left_ctg_ids.add(x[0])
-	for x in right_contig_copies:
-		right_ctg_ids.add(x[0])
-	return compute_match_cost(left_contig_copies, right_contig_copies, pls_ids_dict, contigs_dict, p)
+		Dictionary of the dissimilarity (raw and normalized) and the number of recursive calls
+	'''
+	total_len, total_denom, unique_left_cost, unique_right_cost = compute_unmatched_costs(contigs_dict, p)
+	dissimilarity_score = (unique_left_cost + unique_right_cost + cuts_cost + joins_cost)
+	logger.info(f'contig\tleft_plasmid_id\tleft_plasmid_position\tright_plasmid_id\tright_plasmid_position')
+	matched_copies = [(ctg, l_copy, r_copy) for ctg in final_matching for l_copy, r_copy in zip(*final_matching[ctg])]
+	log_rows(logger, matched_copies, lambda x: f'{x[0]}\t{x[1][1]}\t{x[1][2]}\t{x[2][1]}\t{x[2][2]}', max_log_rows)
 
-def run_compare_plasmids(contigs_dict, pls_ids_dict, p, max_calls, results_file):
+	if total_denom == 0.0: total_denom = 1.0
+	results_writer.write({'Statistic': 'Total_ctg_length', 'Value': total_len})
+	results_writer.write({'Statistic': 'Total_ctg_length_alpha', 'Value': total_denom})
+	for stat, cost in [('Cuts', cuts_cost), ('Joins', joins_cost),
+					   ('Extra_ctgs', unique_left_cost), ('Missing_ctgs', unique_right_cost), ('Dissimilarity', dissimilarity_score)]:
+		results_writer.write({'Statistic': stat, 'Value': cost, 'Normalized': cost/total_denom})
+	return {'dissimilarity': dissimilarity_score, 'normalized': dissimilarity_score/total_denom, 'n_calls': n_calls}
+
+def run_compare_plasmids(contigs_dict, pls_ids_dict, p, max_calls, results_writer, max_log_rows=None, time_budget=None, comp_state=None):
 	'''
 	Input:
 		Dictionary of contigs: 
@@ -253,132 +413,67 @@ def run_compare_plasmids(contigs_dict, pls_ids_dict, p, max_calls, results_file)
 														Each copy is a triple [contig, plasmid index (int), position in plasmid (int)]
 		Dictionary of plasmids, 
 			Keys: L, R, Values: Bidict of plasmid indices <-> names/ids
-	Returns:
+		Results writer (see results_writer.ResultsWriter), with columns COMP_COLUMNS
+		Maximum number of rows of the matching to log (all if None)
+		Maximum time (in seconds) of the branch-and-bound (no limit if None)
+		If not None, state of the previous comparison (dictionary, empty if none), replaced in place by the state of this comparison:
+			Key: block signature (see get_block_signature), 
+			Value: Dictionary of the cost of cuts and joins of the block and its minimum cost matching,
+				   with copies as pairs (plasmid name, position in plasmid)
+			The blocks solved before an exception are added to it
+	Raises:
+		SearchLimitException if the number of recursive calls exceeds max_calls or the time budget is exceeded
+	Writes:
 		Dissimilarity score and associated costs (cuts, joins, contig copies present on only left or right plasmid sets)
+	Returns:
+		Dictionary of the dissimilarity (raw and normalized) and the number of recursive calls
+	The cost of cuts and joins is the sum of the costs of the blocks of plasmids (see get_blocks), searched independently,
+	the matching of the blocks of the previous state being reused
 	'''
 	#Computing set of common contigs 
-	left_ctg_ids = set([ctg for ctg in contigs_dict.keys() if len(contigs_dict[ctg]['L_copies']) >= 1])
-	right_ctg_ids = set([ctg for ctg in contigs_dict.keys() if len(contigs_dict[ctg]['R_copies']) >= 1])
-	common_contigs = left_ctg_ids.intersection(right_ctg_ids)
+	common_contigs = get_common_contigs(contigs_dict)
 
-	#Computing upperbound on number of matchings and final_cost
-	max_cost = 0
-	n_matchings = {}
+	#Computing upperbound on number of matchings
 	max_n_matchings = 1
 	for contig in common_contigs:
 		m = len(contigs_dict[contig]['L_copies'])
 		n = len(contigs_dict[contig]['R_copies'])
-		max_cost += m * contigs_dict[contig]['length']
-		max_cost += n * contigs_dict[contig]['length']	
-		n_matchings[contig] = int(factorial(n)/factorial(n-m)) if n > m else int(factorial(m)/factorial(m-n))
-		max_n_matchings *= n_matchings[contig]
+		max_n_matchings *= int(factorial(n)/factorial(n-m)) if n > m else int(factorial(m)/factorial(m-n))
 	logger.info(f'Maximum possible matchings: {max_n_matchings}')
 
+	blocks = get_blocks(contigs_dict, common_contigs)
 	start_time = time.time()
-	dummy_var = 1
-	if dummy_var == 1:
-		### Branch-N-Bound ###
-		current_state = {'level': 0, 'total_cost': 0, 'matching': {}, 'cuts_cost': 0, 'joins_cost': 0, 'unmatched': {}}
-		final_state = {'total_cost': max_cost, 'matching': {}, 'cuts_cost': 0, 'joins_cost': 0, 'unmatched': {}}
-
-		contig_list = list(common_contigs)
-		sorted_contig_list = sorted(contig_list, key=lambda ctg: n_matchings[ctg])
-
-		count = [0]
-
-		def recursive_compare(current_state, sorted_contig_list, pls_ids_dict, contigs_dict, count):
-			'''
-			Input:
-				Current state dictionary: 
-					level: Distance from root of tree (int)
-					total_cost: Cost of cuts and joins upto this level (int)
-					matching: Nested dictionary with contig ids (str) as keys and a pair (set) of lists of contigs as values
-					cuts_cost, joins_cost: Cost of cuts, joins (respectively) upto this level (int)		
-					unmatched: Nested dictionary with contigs ids (str) as keys and as values, a dictionary with bin ids as keys and number of extra contigs as values 		
-			Updates:
-				Current state dictionary
-				Final state dictionary (non local variable)
-			'''
-			nonlocal final_state
-			if current_state['level'] < len(sorted_contig_list):				#Compute cost upto current level
-				current_contig = sorted_contig_list[current_state['level']]		#Retrieve contig for current level				
-				m = len(contigs_dict[current_contig]['L_copies'])
-				n = len(contigs_dict[current_contig]['R_copies'])			
-				matchings = generate_matchings(m,n)
-				for matching in matchings:
-					matched_posns = get_matching_positions(contigs_dict[current_contig], matching)
-					#matched_posns, unmatched_posns = get_matching_positions(contigs_dict[current_contig], matching)
-					current_state['matching'][current_contig] = matched_posns
-					#current_state['unmatched'][current_contig] = unmatched_posns
-					count[0] += 1
-
-					if count[0] > max_calls:
-						logger.info(f'Max number of iterations reached: {max_calls}'); sys.exit(f'Max number of iterations reached: {max_calls}')
-					current_state['cuts_cost'], current_state['joins_cost'] \
-						= compute_current_cost(current_state['matching'], pls_ids_dict, contigs_dict, p)
-					current_state['total_cost'] = current_state['cuts_cost'] + current_state['joins_cost']
-					if current_state['total_cost'] < final_state['total_cost']:	
-						current_state['level'] += 1 
-						recursive_compare(current_state, sorted_contig_list, pls_ids_dict, contigs_dict, count)
-						current_state['level'] -= 1
-					del current_state['matching'][current_contig]
-
-			else:
-				final_state['total_cost'] = current_state['total_cost']
-				final_state['cuts_cost'], final_state['joins_cost'] = current_state['cuts_cost'], current_state['joins_cost']
-				final_state['matching'] = copy.deepcopy(current_state['matching'])
-		recursive_compare(current_state, sorted_contig_list, pls_ids_dict, contigs_dict, count)
-		
-		end_time = time.time()
-		logger.info(f'Time taken: {end_time - start_time}')
-		logger.info(f'Number of function calls: {count[0]}')	
-		
-		total_len, total_denom, unique_left_cost, unique_right_cost = 0, 0, 0, 0
-		for c in contigs_dict:
-			#if c not in common_contigs:
-			l_copies, r_copies = len(contigs_dict[c]['L_copies']), len(contigs_dict[c]['R_copies'])
-			ctg_len = contigs_dict[c]['length']
-			unique_left_cost += max(l_copies - r_copies, 0) * (ctg_len**p)
-			unique_right_cost += max(r_copies - l_copies, 0) * (ctg_len**p)
-			total_len += (l_copies + r_copies) * ctg_len
-			total_denom += (l_copies + r_copies) * (ctg_len**p)
+	count = [0]
+	cuts_cost, joins_cost, final_matching = 0, 0, {}
+	blocks_state = {}
+	n_searched_blocks = 0
+	for block in blocks:
+		signature = None if comp_state is None else get_block_signature(block, contigs_dict, pls_ids_dict, p)
+		if comp_state is None or signature not in comp_state:
+			block_cuts, block_joins, block_matching = \
+				search_min_matching(block, contigs_dict, pls_ids_dict, p, max_calls, count, start_time, time_budget)
+			n_searched_blocks += 1
+			if comp_state is not None:
+				comp_state[signature] = {
+					'cuts_cost': block_cuts, 'joins_cost': block_joins,
+					'matching': {ctg: tuple([(pls_ids_dict[side].inv[x[1]], x[2]) for x in copies] for side, copies in zip(['L', 'R'], M))
+								 for ctg, M in block_matching.items()}
+				}
+		else:
+			block_cuts, block_joins = comp_state[signature]['cuts_cost'], comp_state[signature]['joins_cost']
+			block_matching = {ctg: tuple([[ctg, pls_ids_dict[side][pls], posn] for (pls, posn) in copies] for side, copies in zip(['L', 'R'], M))
+							  for ctg, M in comp_state[signature]['matching'].items()}
+		if comp_state is not None:
+			blocks_state[signature] = comp_state[signature]
+		cuts_cost += block_cuts
+		joins_cost += block_joins
+		final_matching.update(block_matching)
+	end_time = time.time()
+	if comp_state is not None:
+		comp_state.clear()
+		comp_state.update(blocks_state)
+		logger.info(f'Recomputed blocks: {n_searched_blocks}/{len(blocks)}')
+	logger.info(f'Time taken: {end_time - start_time}')
+	logger.info(f'Number of function calls: {count[0]}')	
 
-		'''
-		uncommon_copies_per_bin = {}
-		for c in contigs_dict:
-			if c not in common_contigs:
-				uncommon_copies_per_bin[c] = {}
-				l_copies, r_copies = len(contigs_dict[c]['L_copies']), len(contigs_dict[c]['R_copies'])
-				if l_copies > r_copies:
-					for l_copy in contigs_dict[c]['L_copies']:
-						bin_id = l_copy[1]
-						if bin_id not in uncommon_copies_per_bin[c]:
-							uncommon_copies_per_bin[c][bin_id] = 0
-						uncommon_copies_per_bin[c] += 1	
-				else:
-					for r_copy in contigs_dict[c]['R_copies']:
-						bin_id = r_copy[1]
-						if bin_id not in uncommon_copies_per_bin[c]:
-							uncommon_copies_per_bin[c][bin_id] = 0
-						uncommon_copies_per_bin[c] += 1	
-		'''
-				
-					
-				 
-
-
-		dissimilarity_score = (unique_left_cost + unique_right_cost + final_state['total_cost'])
-		logger.info(f'contig\tleft_plasmid_id\tleft_plasmid_position\tright_plasmid_id\tright_plasmid_position')
-		for ctg in final_state["matching"]:
-			n_copies = len(final_state["matching"][ctg][0])
-			for i in range(n_copies):
-				logger.info(f'{ctg}\t{final_state["matching"][ctg][0][i][1]}\t{final_state["matching"][ctg][0][i][2]}\t{final_state["matching"][ctg][1][i][1]}\t{final_state["matching"][ctg][1][i][2]}')
-                
-		if total_denom == 0.0: total_denom = 1.0
-		results_file.write("Total_ctg_length\t" + str(total_len) + "\n")
-		results_file.write("Total_ctg_length_alpha\t" + str(total_denom) + "\n")
-		results_file.write("Cuts\t" + str(final_state['cuts_cost']) + "\t" + str(final_state['cuts_cost']/total_denom) + "\n")
-		results_file.write("Joins\t" + str(final_state['joins_cost']) + "\t" + str(final_state['joins_cost']/total_denom) + "\n")
-		results_file.write("Extra_ctgs\t" + str(unique_left_cost) + "\t" + str(unique_left_cost/total_denom) + "\n")
-		results_file.write("Missing_ctgs\t" + str(unique_right_cost) + "\t" + str(unique_right_cost/total_denom) + "\n")
-		results_file.write("Dissimilarity\t" + str(dissimilarity_score) + "\t" + str(dissimilarity_score/total_denom) + "\n")
+	return write_comparison(contigs_dict, p, cuts_cost, joins_cost, final_matching, count[0], results_writer, max_log_rows)
@@ -4,15 +4,101 @@ from __future__ import division
 import pandas as pd
 import os
 import logging
+from collections import defaultdict
 
 from log_errors_utils import (
 	check_file,
-	create_directory
+	create_directory,
+	log_rows
 )
+from results_writer import ResultsWriter
+from sample_stream import iter_sample_pairs
+from state_store import StateStore, digest
 
 logger = logging.getLogger(__name__)
 
-def eval_bins(pred_dict, pls_dict, len_dict, th_len, eval_file):
+EVAL_COLUMNS = [
+	('Level', 'str'), ('Statistic', 'str'), ('Bin', 'str'),
+	('Unwtd_Stat', 'float'), ('Wtd_Stat', 'float'), ('Unwtd_Match', 'str'), ('Wtd_Match', 'str')
+]
+#Individual rows of the tsv output file interleave statistics and matches, unlike the header (layout kept as is)
+INDIVIDUAL_TSV_ORDER = ['Level', 'Statistic', 'Bin', 'Unwtd_Stat', 'Unwtd_Match', 'Wtd_Stat', 'Wtd_Match']
+
+def compute_contingency(pred_dict, pls_dict, len_dict, th_len, pred_bins=None):
+	'''
+	Input:
+		Dictionary of predicted bins (Key: Bin id, Value: List of contigs)
+		Dictionary of true plasmid bins (Key: Bin id, Value: List of contigs)
+		Dictionary of contig lengths
+		Length threshold
+		List of predicted bins to account for (all if None)
+	Returns:
+		Contingency dictionary: Key: predicted bin id, 
+								Value: Dictionary with Key: id of true plasmid bin sharing contigs with the predicted bin,
+													   Value: Pair (number, total length) of common contigs
+	'''
+	gt_bins_by_ctg = defaultdict(list)
+	for gt_bin in pls_dict:
+		for ctg in pls_dict[gt_bin]:
+			gt_bins_by_ctg[ctg].append(gt_bin)
+	contingency = {}
+	for pred_bin in (pred_dict if pred_bins is None else pred_bins):
+		common = {}
+		for ctg in pred_dict[pred_bin]:
+			ctg_len = len_dict[ctg]
+			if ctg_len >= th_len:
+				for gt_bin in gt_bins_by_ctg.get(ctg, []):
+					ncommon_ctgs, lencommon_ctgs = common.get(gt_bin, (0, 0))
+					common[gt_bin] = (ncommon_ctgs + 1, lencommon_ctgs + ctg_len)
+		contingency[pred_bin] = common
+	return contingency
+
+def get_bin_digests(bins_dict, len_dict):
+	'''
+	Input: Dictionary of bins (Key: Bin id, Value: List of contigs), dictionary of contig lengths
+	Returns: Dictionary: Key: Bin id, Value: Digest of the contigs of the bin and their lengths
+	'''
+	return {bin_id: digest(sorted((ctg, int(len_dict[ctg])) for ctg in bins_dict[bin_id])) for bin_id in bins_dict}
+
+def update_contingency(eval_state, pred_dict, pls_dict, len_dict, th_len):
+	'''
+	Input:
+		State of the previous evaluation (dictionary, empty if none), replaced in place by the state of this evaluation:
+			th_len: Length threshold
+			gt_digest: Digest of the true plasmid bins (contigs and their lengths)
+			pred_digests: Digests of the predicted bins (see get_bin_digests)
+			contingency: Contingency dictionary (see compute_contingency)
+		Dictionaries of predicted bins, true plasmid bins and contig lengths
+		Length threshold
+	Returns:
+		Contingency dictionary, recomputed only for the predicted bins whose contigs (or their lengths) changed,
+		unless the true plasmid bins or the length threshold changed
+		Number of recomputed predicted bins
+	'''
+	pred_digests = get_bin_digests(pred_dict, len_dict)
+	gt_digest = digest(sorted(get_bin_digests(pls_dict, len_dict).items()))
+	if eval_state.get('th_len') != th_len or eval_state.get('gt_digest') != gt_digest:
+		changed_bins = list(pred_dict)
+	else:
+		old_pred_digests = eval_state['pred_digests']
+		changed_bins = [pred_bin for pred_bin in pred_dict if pred_digests[pred_bin] != old_pred_digests.get(pred_bin)]
+	contingency = compute_contingency(pred_dict, pls_dict, len_dict, th_len, changed_bins)
+	for pred_bin in pred_dict:
+		if pred_bin not in contingency:
+			contingency[pred_bin] = eval_state['contingency'][pred_bin]
+	eval_state.clear()
+	eval_state.update({'th_len': th_len, 'gt_digest': gt_digest, 'pred_digests': pred_digests, 'contingency': contingency})
+	return contingency, len(changed_bins)
+
+def eval_bins(pred_dict, pls_dict, len_dict, th_len, eval_writer, max_log_rows=None, contingency=None):
+	'''
+	Computes and writes precision and recall statistics of the predicted bins (pred_dict) against the true plasmid bins (pls_dict)
+	The contingency dictionary of the bins (see compute_contingency) is computed if not given
+	Returns the overall statistics
+	'''
+	if contingency is None:
+		contingency = compute_contingency(pred_dict, pls_dict, len_dict, th_len)
+
 	#Following functions are used to compute precision and recall,
 	#	for each predicted bin and true plasmid bin respectively
 	def create_bin_entry():
@@ -43,30 +129,23 @@ def eval_bins(pred_dict, pls_dict, len_dict, th_len, eval_file):
 				len_ctgs += ctg_len
 		return n_ctgs, len_ctgs	
 	
-	def compute_best_bin(stat_dict, ctg_list, opp_bins_dict, len_dict, th_len):
+	def compute_best_bin(stat_dict, common_dict, opp_bins_dict):
 		'''
 		Input:
 			Dictionary of weighted and unweighted statistics for the bin in question
-			List of contigs forming the bin
+			Dictionary of contigs shared with the bins against which to compute statistics:
+				Key: Bin id, Value: Pair (number, total length) of common contigs (longer than the length threshold)
 			Dictionary of bins against which to compute statistics:
 				For computing precision: dictionary of true plasmid bins 
 				For computing recall: dictionary of predicted bins 
 				Format: (Key: Bin id, Value: List of contigs)
-			Dictionary of contig lengths
-			Length threshold
 		Returns:
 			Dictionary of weighted and unweighted statistics for the bin in question
 			updated with best matched bin details
 		'''
 		n_ctgs, len_ctgs = stat_dict['unwtd']['Total'], stat_dict['wtd']['Total']
 		for bin_id in opp_bins_dict:
-			common_ctgs = set(opp_bins_dict[bin_id]).intersection(set(ctg_list))
-			ncommon_ctgs, lencommon_ctgs = 0, 0
-			for ctg in common_ctgs:
-				ctg_len = len_dict[ctg]
-				if ctg_len >= th_len:
-					ncommon_ctgs += 1
-					lencommon_ctgs += ctg_len
+			ncommon_ctgs, lencommon_ctgs = common_dict.get(bin_id, (0, 0))
 			n_stat, len_stat = 0, 0
 			if n_ctgs >= 1:
 				n_stat = ncommon_ctgs / n_ctgs
@@ -79,20 +158,24 @@ def eval_bins(pred_dict, pls_dict, len_dict, th_len, eval_file):
 	
 	recall = {}
 	precision = {}
+	recall_common = defaultdict(dict)
+	for pred_pls in contingency:
+		for ref_pls in contingency[pred_pls]:
+			recall_common[ref_pls][pred_pls] = contingency[pred_pls][ref_pls]
 
 	for ref_pls in pls_dict:
 		recall[ref_pls] = create_bin_entry()
 		nref_ctgs, lenref_ctgs = get_total_ctgs(pls_dict[ref_pls], len_dict, th_len)
 		recall[ref_pls]['unwtd']['Total'] = nref_ctgs
 		recall[ref_pls]['wtd']['Total'] = lenref_ctgs
-		recall[ref_pls] = compute_best_bin(recall[ref_pls], pls_dict[ref_pls], pred_dict, len_dict, th_len)
+		recall[ref_pls] = compute_best_bin(recall[ref_pls], recall_common[ref_pls], pred_dict)
 
 	for pred_pls in pred_dict:
 		precision[pred_pls] = create_bin_entry()
 		npred_ctgs, lenpred_ctgs = get_total_ctgs(pred_dict[pred_pls], len_dict, th_len)
 		precision[pred_pls]['unwtd']['Total'] = npred_ctgs
 		precision[pred_pls]['wtd']['Total'] = lenpred_ctgs
-		precision[pred_pls] = compute_best_bin(precision[pred_pls], pred_dict[pred_pls], pls_dict, len_dict, th_len)
+		precision[pred_pls] = compute_best_bin(precision[pred_pls], contingency[pred_pls], pls_dict)
 
 	#Following functions are used to compute overall statistics and to write to the output file
 	def compute_overall_details(stat_dict, best_match, ovr_dict):
@@ -111,20 +194,26 @@ def eval_bins(pred_dict, pls_dict, len_dict, th_len, eval_file):
 		ovr_dict['ovr_len_total'] += stat_dict['wtd']['Total']
 		return best_match, ovr_dict
 	
-	def write_best_match_details(eval_file, bin_id, best_match,stat_type):
+	def best_match_row(bin_id, best_match, stat_type):
 		'''
 		Input: 
-			Output file
 			Bin id
 			Details of bin matched to bin in question
-		Output: None
+		Output: Row of the output file for the bin in question
+		'''
+		n_bin, len_bin = (best_match['n_bin'], best_match['len_bin']) if best_match['n_bin'] else (None, None)
+		return {
+			'Level': 'Individual', 'Statistic': stat_type, 'Bin': bin_id,
+			'Unwtd_Stat': best_match['n_stat'], 'Wtd_Stat': best_match['len_stat'],
+			'Unwtd_Match': n_bin, 'Wtd_Match': len_bin
+		}
+
+	def best_match_log(row):
 		'''
-		if best_match['n_bin']:
-			logger.info(f"{bin_id}\t{str(best_match['n_stat'])}\t{best_match['n_bin']}\t{str(best_match['len_stat'])}\t{best_match['len_bin']}")
-			eval_file.write(f"Individual\t{stat_type}\t{bin_id}\t{str(best_match['n_stat'])}\t{best_match['n_bin']}\t{str(best_match['len_stat'])}\t{best_match['len_bin']}\n")
-		else:
-			logger.info(f"{bin_id}\t{str(best_match['n_stat'])}\t{None}\t{str(best_match['len_stat'])}\t{None}")
-			eval_file.write(f"Individual\t{stat_type}\t{bin_id}\t{str(best_match['n_stat'])}\t{None}\t{str(best_match['len_stat'])}\t{None}\n")			
+		Input: Row of the output file for a bin
+		Output: Line of the log file for the bin
+		'''
+		return f"{row['Bin']}\t{str(row['Unwtd_Stat'])}\t{row['Unwtd_Match']}\t{str(row['Wtd_Stat'])}\t{row['Wtd_Match']}"
 		
 	def compute_overall_stat(ovr_details):
 		'''
@@ -138,17 +227,19 @@ def eval_bins(pred_dict, pls_dict, len_dict, th_len, eval_file):
 			ovr_len_stat = ovr_details['ovr_len_common']/ovr_details['ovr_len_total']	
 		return ovr_n_stat, ovr_len_stat
 
-	eval_file.write(f'Level\tStatistic\tBin\tUnwtd_Stat\tWtd_Stat\tUnwtd_Match\tWtd_Match\n')
-	
 	logger.info(f'#Precision: Proportion of correctedly identified contigs for each prediction')
 	logger.info(f'>Precision details')
 	logger.info(f'#Predicted_bin\tUnwtd_Precision\tUnwtd_Reference_plasmid\tWtd_Precision\tWtd_Reference_plasmid')
 	ovr_details = {'ovr_n_common': 0, 'ovr_len_common': 0, 'ovr_n_total': 0, 'ovr_len_total': 0}
+	rows = []
 	for bin_id in precision:
 		best_match_details = {'n_stat': None, 'n_bin': None, 'len_stat': None, 'len_bin': None}
 		best_match_details, ovr_details = \
 			compute_overall_details(precision[bin_id], best_match_details, ovr_details)
-		write_best_match_details(eval_file, bin_id, best_match_details, 'Precision')
+		rows.append(best_match_row(bin_id, best_match_details, 'Precision'))
+	log_rows(logger, rows, best_match_log, max_log_rows)
+	for row in rows:
+		eval_writer.write(row, INDIVIDUAL_TSV_ORDER)
 	ovr_n_prec, ovr_len_prec = compute_overall_stat(ovr_details)
 	ovr_n_prec = float("{:.4f}".format(ovr_n_prec))
 	ovr_len_prec = float("{:.4f}".format(ovr_len_prec))
@@ -160,11 +251,15 @@ def eval_bins(pred_dict, pls_dict, len_dict, th_len, eval_file):
 	logger.info(f'#Reference_plasmid\tUnwtd_Recall\tUnwtd_Predicted_bin\tWtd_Recall\tWtd_Predicted_bin')
 	ovr_details = {'ovr_n_common': 0, 'ovr_len_common': 0, 'ovr_n_total': 0, 'ovr_len_total': 0}
 	ovr_n_rec, ovr_len_rec = 0, 0
+	rows = []
 	for bin_id in recall:
 		best_match_details = {'n_stat': None, 'n_bin': None, 'len_stat': None, 'len_bin': None}
 		best_match_details, ovr_details = \
 			compute_overall_details(recall[bin_id], best_match_details, ovr_details)
-		write_best_match_details(eval_file, bin_id, best_match_details, 'Recall')
+		rows.append(best_match_row(bin_id, best_match_details, 'Recall'))
+	log_rows(logger, rows, best_match_log, max_log_rows)
+	for row in rows:
+		eval_writer.write(row, INDIVIDUAL_TSV_ORDER)
 	ovr_n_rec, ovr_len_rec = compute_overall_stat(ovr_details)	
 	ovr_n_rec = float("{:.4f}".format(ovr_n_rec))
 	ovr_len_rec = float("{:.4f}".format(ovr_len_rec))
@@ -178,6 +273,11 @@ def eval_bins(pred_dict, pls_dict, len_dict, th_len, eval_file):
 		len_f1 = 2*ovr_len_prec*ovr_len_rec / (ovr_len_prec + ovr_len_rec)	
 	n_f1 = float("{:.4f}".format(n_f1))
 	len_f1 = float("{:.4f}".format(len_f1))
+	overall = {
+		'unwtd_precision': ovr_n_prec, 'wtd_precision': ovr_len_prec,
+		'unwtd_recall': ovr_n_rec, 'wtd_recall': ovr_len_rec,
+		'unwtd_f1': n_f1, 'wtd_f1': len_f1
+	}
 	
 	logger.info(f'#Final statistics (Unwtd and Wtd)')
 	logger.info(f'>Overall details')
@@ -185,21 +285,24 @@ def eval_bins(pred_dict, pls_dict, len_dict, th_len, eval_file):
 	logger.info(f'Precision\t{str(ovr_n_prec)}\t{str(ovr_len_prec)}')
 	logger.info(f'Recall\t{str(ovr_n_rec)}\t{str(ovr_len_rec)}')
 	logger.info(f'F1\t{str(n_f1)}\t{str(len_f1)}')
-	eval_file.write(f'Overall\tPrecision\t{None}\t{str(ovr_n_prec)}\t{str(ovr_len_prec)}\t{None}\t{None}\n')
-	eval_file.write(f'Overall\tRecall\t{None}\t{str(ovr_n_rec)}\t{str(ovr_len_rec)}\t{None}\t{None}\n')
-	eval_file.write(f'Overall\tF1\t{None}\t{str(n_f1)}\t{str(len_f1)}\t{None}\t{None}\n')
+	for stat_type, n_stat, len_stat in [('Precision', ovr_n_prec, ovr_len_prec), ('Recall', ovr_n_rec, ovr_len_rec), ('F1', n_f1, len_f1)]:
+		eval_writer.write({
+			'Level': 'Overall', 'Statistic': stat_type, 'Bin': None,
+			'Unwtd_Stat': n_stat, 'Wtd_Stat': len_stat, 'Unwtd_Match': None, 'Wtd_Match': None
+		})
+	return overall
 
 
 def get_bin_details(len_dict, bins_file):
 	'''
 	Input: 
-		path to input file
+		path to input file, or DataFrame of its rows
 		len_dict: Key: contig (str), Value: length (int), 
 	Returns:
 		pls_dict: Key: plasmid id (str), Value: list of contig ids
 		updated len_dict
 	'''
-	pls_ctg_df = pd.read_csv(bins_file, sep='\t')
+	pls_ctg_df = bins_file if isinstance(bins_file, pd.DataFrame) else pd.read_csv(bins_file, sep='\t')
 	pls_dict = {}
 	for _, row in pls_ctg_df.iterrows():
 		plasmid, contig, length = row['plasmid'], str(row['contig']), row['contig_len']
@@ -210,19 +313,27 @@ def get_bin_details(len_dict, bins_file):
 			pls_dict[plasmid].append(contig)
 	return pls_dict, len_dict
 
-def eval_mode(pred_file, gt_file, min_len, output_file, log_file):
+def eval_mode(pred_file, gt_file, min_len, output_file, log_file, out_format='tsv', append=False, sample=None, max_log_rows=None,
+			  sample_col=None, chunksize=100000, state_file=None):
 	'''
 	Reads prediction and ground truth files
 	Initializes dictionaries and stores prediction and ground truth bins
 	Initializes and populates a dictionary of contig lengths 
 	Calls the eval_bins function to compute the precision and recall statistics
+	Results are written in the given format (tsv, jsonl or parquet), with an extra first column if a sample name is given,
+	and at most max_log_rows rows of each per-bin section are logged
+	If sample_col is not None, both files contain many samples (contiguous rows with the same value in column sample_col, sorted by sample),
+	read by chunks of rows and evaluated one at a time, the results of each sample being written once it is evaluated
+	If state_file is not None, the contingency of the bins of each sample is saved to it and, if it exists,
+	only the predicted bins that changed since the previous run are recomputed
 	'''
 	for in_file in [pred_file, gt_file]:
 		check_file(in_file)
 	output_dir = os.path.dirname(output_file)
 	log_dir = os.path.dirname(log_file)
 	create_directory([output_dir, log_dir])
-	eval_file = open(output_file, "w")
+	eval_writer = ResultsWriter(output_file, EVAL_COLUMNS, out_format=out_format, append=append, sample=sample,
+							   with_sample=sample_col is not None)
 	# Initialize logging
 	logging.basicConfig(
 		filename=log_file,
@@ -231,9 +342,29 @@ def eval_mode(pred_file, gt_file, min_len, output_file, log_file):
 		format='%(name)s - %(levelname)s - %(message)s'
 	)
 	#Reading data and saving it to a dictionary with plasmids as keys and a nested dictionary of contigs as values
-	len_dict = {}
-	pred_dict, len_dict = get_bin_details(len_dict, pred_file)
-	gt_dict, len_dict = get_bin_details(len_dict, gt_file)
-	eval_bins(pred_dict, gt_dict, len_dict, min_len, eval_file)
+	if sample_col is None:
+		samples = [(sample, pred_file, gt_file)]
+	else:
+		samples = iter_sample_pairs(pred_file, gt_file, sample_col, chunksize)
+	state_store = None if state_file is None else StateStore(state_file, 'eval')
+	for sample_id, pred_bins, gt_bins in samples:
+		if sample_col is not None:
+			logger.info(f'>Sample\t{sample_id}')
+			eval_writer.set_sample(sample_id)
+		len_dict = {}
+		pred_dict, len_dict = get_bin_details(len_dict, pred_bins)
+		gt_dict, len_dict = get_bin_details(len_dict, gt_bins)
+		contingency = None
+		if state_store is not None:
+			eval_state = state_store.load(sample_id)
+			contingency, n_changed = update_contingency(eval_state, pred_dict, gt_dict, len_dict, min_len)
+			logger.info(f'Recomputed predicted bins: {n_changed}/{len(pred_dict)}')
+		eval_bins(pred_dict, gt_dict, len_dict, min_len, eval_writer, max_log_rows, contingency)
+		eval_writer.flush()
+		if state_store is not None:
+			state_store.save(sample_id, eval_state)
+	eval_writer.close()
+	if state_store is not None:
+		state_store.close(prune=sample_col is not None)
 
 			
@@ -43,6 +43,14 @@ def process_warning(msg):
     logging.warning(msg)
     print(f'WARNING\t{msg}', file=sys.stderr)
 
+def log_rows(logger, rows, row_to_str, max_rows=None):
+    """Log the rows of a verbose section, only the first max_rows ones if max_rows is not None."""
+    n_logged = len(rows) if max_rows is None else min(max_rows, len(rows))
+    for row in rows[:n_logged]:
+        logger.info(row_to_str(row))
+    if n_logged < len(rows):
+        logger.info(f'... {len(rows) - n_logged} more rows not logged')
+
 """ Files and directories function """
 def create_directory(in_dir_list):
     for in_dir in in_dir_list:
@@ -6,10 +6,23 @@
 # Two modes of PlasEval:
 # - eval: evaluates plasmid bins against a set of ground truth bins to provide precision-recall statistics
 # - compare: compares two sets of plasmid bins to quantify the dissimilarity between the two given sets 
+# Both modes can be run on many inputs with the batch mode, recorded in a job store summarized by the summary mode
 
-import plasmid_comparison_main as pcm, evaluate_bins as eb
+import plasmid_comparison_main as pcm, evaluate_bins as eb, batch_runner as br
+from results_writer import OUT_FORMATS
 import argparse
 
+def add_samples_arguments(mode_parser):
+	mode_parser.add_argument("--sample_col", default=None, help="Name of the sample column of multi-sample input files (rows of a sample must be contiguous, samples sorted by name)")
+	mode_parser.add_argument("--chunksize", type=int, default=100000, help="Number of rows of multi-sample input files read at a time")
+	mode_parser.add_argument("--state_file", default=None, help="Path to state file of a previous run, only the bins that changed since are recomputed (created if missing)")
+
+def add_output_arguments(mode_parser):
+	mode_parser.add_argument("--out_format", choices=OUT_FORMATS, default="tsv", help="Format of output file")
+	mode_parser.add_argument("--append", action="store_true", help="Append results to output file instead of overwriting it")
+	mode_parser.add_argument("--sample", default=None, help="Sample name, written in an extra first column of output file")
+	mode_parser.add_argument("--log_rows", type=int, default=None, help="Maximum number of rows logged for per-bin details (eval) or contigs matching (comp), 0 to disable")
+
 def main():
 	parser = argparse.ArgumentParser()
 	subparsers = parser.add_subparsers(help = "mode to be used", dest = "mode")
@@ -21,6 +34,8 @@ def main():
 	eval_parser.add_argument("--min_len", type=int, default=0, help="Minimum length of contigs")
 	eval_parser.add_argument("--out_file", help="Path to output file")
 	eval_parser.add_argument("--log_file", help="Path to log file")
+	add_samples_arguments(eval_parser)
+	add_output_arguments(eval_parser)
 	#Compare mode
 	comp_parser = subparsers.add_parser("comp", help = "compare two sets of plasmid bins")
 	comp_parser.add_argument("--l", help="Path to file with 1st set of plasmids")
@@ -28,14 +43,42 @@ def main():
 	comp_parser.add_argument("--p",  type=float, default=0.5, help="Weight exponent")
 	comp_parser.add_argument("--min_len",  type=int, default=0, help="Minimum length of contigs")
 	comp_parser.add_argument("--max_calls",  type=int, default=10000000, help="Maximum number of recursive function calls")
+	comp_parser.add_argument("--bounds_only", action="store_true", help="Only compute lower and upper bounds on the dissimilarity (no branch-and-bound)")
 	comp_parser.add_argument("--out_file", help="Path to output file")
 	comp_parser.add_argument("--log_file", help="Path to log file")
+	add_samples_arguments(comp_parser)
+	add_output_arguments(comp_parser)
+	#Batch mode
+	batch_parser = subparsers.add_parser("batch", help = "run eval and comp jobs recorded in a job store")
+	batch_parser.add_argument("--jobs", help="Path to jobs file (columns job_id, mode, input_1, input_2, optional min_len, p, max_calls)")
+	batch_parser.add_argument("--db", help="Path to SQLite job store")
+	batch_parser.add_argument("--out_dir", help="Path to output directory")
+	batch_parser.add_argument("--shard", default="1/1", help="Run only the jobs of shard i out of N (i/N)")
+	batch_parser.add_argument("--p",  type=float, default=0.5, help="Weight exponent")
+	batch_parser.add_argument("--min_len",  type=int, default=0, help="Minimum length of contigs")
+	batch_parser.add_argument("--max_calls",  type=int, default=10000000, help="Maximum number of recursive function calls")
+	batch_parser.add_argument("--time_budget", type=float, default=None, help="Maximum time (in seconds) of each comparison search")
+	batch_parser.add_argument("--bounds_threshold", type=float, default=None, help="Skip the comparison search when the dissimilarity bounds are equal or on the same side of this threshold")
+	batch_parser.add_argument("--retry_failed", action="store_true", help="Run again failed jobs")
+	batch_parser.add_argument("--out_format", choices=OUT_FORMATS, default="tsv", help="Format of output files")
+	batch_parser.add_argument("--log_rows", type=int, default=None, help="Maximum number of rows logged for per-bin details (eval) or contigs matching (comp), 0 to disable")
+	#Summary mode
+	summary_parser = subparsers.add_parser("summary", help = "summarize job stores of batch runs")
+	summary_parser.add_argument("--db", nargs="+", help="Path(s) to SQLite job store(s)")
+	summary_parser.add_argument("--n_slowest", type=int, default=10, help="Number of slowest jobs to report")
 	args = parser.parse_args()
 
 	if args.mode == "eval":
-		eb.eval_mode(args.pred, args.gt, args.min_len, args.out_file, args.log_file)
+		eb.eval_mode(args.pred, args.gt, args.min_len, args.out_file, args.log_file, \
+			args.out_format, args.append, args.sample, args.log_rows, args.sample_col, args.chunksize, args.state_file)
 	if args.mode == "comp":
-		pcm.comp_mode(args.l, args.r, args.p, args.min_len, args.max_calls, args.out_file, args.log_file)
+		pcm.comp_mode(args.l, args.r, args.p, args.min_len, args.max_calls, args.out_file, args.log_file, args.bounds_only, \
+			args.out_format, args.append, args.sample, args.log_rows, args.sample_col, args.chunksize, args.state_file)
+	if args.mode == "batch":
+		br.run_batch(args.jobs, args.db, args.out_dir, args.shard, args.min_len, args.p, args.max_calls, args.time_budget, \
+			args.bounds_threshold, args.retry_failed, args.out_format, args.log_rows)
+	if args.mode == "summary":
+		br.summary_mode(args.db, args.n_slowest)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -2,12 +2,23 @@ __author__ = "amane"
 
 import logging
 import os
+import sys
 
 import pandas as pd
 from bidict import bidict
 
 import compare_sets
-from log_errors_utils import check_file, create_directory
+from log_errors_utils import (
+    CustomException,
+    check_file,
+    create_directory,
+    process_warning,
+)
+from results_writer import ResultsWriter
+from sample_stream import iter_sample_pairs
+from state_store import StateStore
+
+logger = logging.getLogger(__name__)
 
 
 def get_plasmid_details(contigs_dict, filename, side, min_len):
@@ -16,7 +27,7 @@ def get_plasmid_details(contigs_dict, filename, side, min_len):
     Arguments
     ---------
     contigs_dict: Key: contig (str), Value: Nested dictionary: length (int), L_copies/R_copies (list of contig copies in plasmid set)
-    path to input file
+    path to input file, or DataFrame of its rows
     side ('L' or 'R')
 
     Returns
@@ -28,7 +39,11 @@ def get_plasmid_details(contigs_dict, filename, side, min_len):
     plasmids = []
     plasmids_keys = bidict()
     count = 0
-    pls_ctg_df = pd.read_csv(filename, sep="\t")
+    pls_ctg_df = (
+        filename
+        if isinstance(filename, pd.DataFrame)
+        else pd.read_csv(filename, sep="\t")
+    )
 
     for _, row in pls_ctg_df.iterrows():
         plasmid, contig, length = (
@@ -55,6 +70,102 @@ def get_plasmid_details(contigs_dict, filename, side, min_len):
     return contigs_dict, plasmids_keys
 
 
+def get_plasmid_sets(left_bins, right_bins, min_len):
+    """Get the details of two sets of plasmid bins.
+
+    Arguments
+    ---------
+    left_bins, right_bins: paths to input files, or DataFrames of their rows
+    min_len: minimum length of contigs
+
+    Returns
+    -------
+    contigs_dict: see get_plasmid_details
+    pls_ids_dict: Keys: L, R, Values: bidict of plasmid indices <-> plasmid names/ids
+    """
+    # Reading data and saving it to a dictionary with plasmids as keys and a nested dictionary of contigs as values
+    contigs_dict = {}
+    pls_ids_dict = {"L": {}, "R": {}}
+    contigs_dict, pls_ids_dict["L"] = get_plasmid_details(
+        contigs_dict,
+        left_bins,
+        "L",
+        min_len,
+    )
+    contigs_dict, pls_ids_dict["R"] = get_plasmid_details(
+        contigs_dict,
+        right_bins,
+        "R",
+        min_len,
+    )
+    return contigs_dict, pls_ids_dict
+
+
+def compare_sample(
+    left_bins,
+    right_bins,
+    p,
+    min_len,
+    max_calls,
+    results_writer,
+    bounds_only=False,
+    max_log_rows=None,
+    time_budget=None,
+    bounds_threshold=None,
+    comp_state=None,
+):
+    """Compare two sets of plasmid bins.
+
+    Arguments
+    ---------
+    left_bins, right_bins: paths to input files, or DataFrames of their rows
+    results_writer: ResultsWriter with columns compare_sets.COMP_COLUMNS
+    time_budget: maximum time (in seconds) of the branch-and-bound, no limit if None
+    bounds_threshold: if not None, threshold on the normalized dissimilarity;
+        the branch-and-bound is skipped, and only the bounds are written, if the
+        bounds on the dissimilarity are equal or on the same side of the threshold
+    comp_state: if not None, state of the previous comparison of the sample
+        (dictionary, empty if none), updated in place; only the blocks of
+        plasmids that changed are searched (see
+        compare_sets.run_compare_plasmids)
+    other arguments: see comp_mode
+
+    Returns
+    -------
+    dictionary of bounds on the dissimilarity if bounds_only or if the bounds
+    decide the threshold, else dictionary of the dissimilarity and number of
+    recursive calls
+
+    Raises
+    ------
+    compare_sets.SearchLimitException (a CustomException) if the number of
+    recursive calls exceeds max_calls or the time budget is exceeded
+    """
+    contigs_dict, pls_ids_dict = get_plasmid_sets(left_bins, right_bins, min_len)
+    bounds = None
+    if bounds_threshold is not None:
+        bounds = compare_sets.compute_bounds(contigs_dict, pls_ids_dict, p)
+        bounds_only = compare_sets.bounds_decide(bounds, bounds_threshold)
+    if bounds_only:
+        return compare_sets.run_compare_bounds(
+            contigs_dict,
+            pls_ids_dict,
+            p,
+            results_writer,
+            bounds,
+        )
+    return compare_sets.run_compare_plasmids(
+        contigs_dict,
+        pls_ids_dict,
+        p,
+        max_calls,
+        results_writer,
+        max_log_rows,
+        time_budget,
+        comp_state,
+    )
+
+
 def comp_mode(
     left_plasmids_file,
     right_plasmids_file,
@@ -63,18 +174,46 @@ def comp_mode(
     max_calls,
     output_file,
     log_file,
+    bounds_only=False,
+    out_format="tsv",
+    append=False,
+    sample=None,
+    max_log_rows=None,
+    sample_col=None,
+    chunksize=100000,
+    state_file=None,
 ):
     """
     Reads input files
     Initializes plasmid dicts and stores plasmid bins for both sides
-    Calls compare_sets function to compute dissimilarity between the two sides
+    Calls compare_sets function to compute dissimilarity between the two sides,
+    or only lower and upper bounds on it if bounds_only is set
+    Results are written in the given format (tsv, jsonl or parquet), with an
+    extra first column if a sample name is given, and at most max_log_rows rows
+    of the matching are logged
+    If sample_col is not None, both files contain many samples (contiguous rows
+    with the same value in column sample_col, sorted by sample), read by chunks of rows and
+    compared one at a time, the results of each sample being written once it is
+    compared; samples exceeding max_calls are skipped with a warning
+    If state_file is not None, the matching of each block of plasmids connected
+    by common contigs is saved to it (see state_store.StateStore) and, if it
+    exists, the matchings of the previous run are reused for the blocks that
+    did not change, including blocks solved before a comparison failed
     """
     for in_file in [left_plasmids_file, right_plasmids_file]:
         check_file(in_file)
     output_dir = os.path.dirname(output_file)
     log_dir = os.path.dirname(log_file)
     create_directory([output_dir, log_dir])
-    results_file = open(output_file, "w")
+    results_writer = ResultsWriter(
+        output_file,
+        compare_sets.COMP_COLUMNS,
+        out_format=out_format,
+        header=False,
+        append=append,
+        sample=sample,
+        with_sample=sample_col is not None,
+    )
     # Initialize logging
     logging.basicConfig(
         filename=log_file,
@@ -82,25 +221,59 @@ def comp_mode(
         level=logging.INFO,
         format="%(name)s - %(levelname)s - %(message)s",
     )
-    # Reading data and saving it to a dictionary with plasmids as keys and a nested dictionary of contigs as values
-    contigs_dict = {}
-    pls_ids_dict = {"L": {}, "R": {}}
-    contigs_dict, pls_ids_dict["L"] = get_plasmid_details(
-        contigs_dict,
+    state_store = None if state_file is None else StateStore(state_file, "comp")
+    if sample_col is None:
+        comp_state = None if state_store is None else state_store.load(sample)
+        try:
+            comparison = compare_sample(
+                left_plasmids_file,
+                right_plasmids_file,
+                p,
+                min_len,
+                max_calls,
+                results_writer,
+                bounds_only,
+                max_log_rows,
+                comp_state=comp_state,
+            )
+        except CustomException as e:
+            # Keep the blocks solved before the failure
+            if state_store is not None:
+                state_store.save(sample, comp_state)
+                state_store.close()
+            sys.exit(str(e))
+        results_writer.close()
+        if state_store is not None:
+            state_store.save(sample, comp_state)
+            state_store.close()
+        return comparison
+    for sample_id, left_df, right_df in iter_sample_pairs(
         left_plasmids_file,
-        "L",
-        min_len,
-    )
-    contigs_dict, pls_ids_dict["R"] = get_plasmid_details(
-        contigs_dict,
         right_plasmids_file,
-        "R",
-        min_len,
-    )
-    compare_sets.run_compare_plasmids(
-        contigs_dict,
-        pls_ids_dict,
-        p,
-        max_calls,
-        results_file,
-    )
+        sample_col,
+        chunksize,
+    ):
+        logger.info(f">Sample\t{sample_id}")
+        results_writer.set_sample(sample_id)
+        comp_state = None if state_store is None else state_store.load(sample_id)
+        try:
+            compare_sample(
+                left_df,
+                right_df,
+                p,
+                min_len,
+                max_calls,
+                results_writer,
+                bounds_only,
+                max_log_rows,
+                comp_state=comp_state,
+            )
+        except CustomException as e:
+            process_warning(f"Sample {sample_id}: {e}")
+        results_writer.flush()
+        if state_store is not None:
+            state_store.save(sample_id, comp_state)
+    results_writer.close()
+    if state_store is not None:
+        state_store.close(prune=True)
+    return None
@@ -0,0 +1,139 @@
+"""Buffered writer of the results of both modes."""
+
+import json
+import os
+
+from log_errors_utils import process_error
+
+OUT_FORMATS = ["tsv", "jsonl", "parquet"]
+
+
+def _to_builtin(value):
+    """Convert numpy scalars (from pandas) to Python builtins."""
+    return value.item() if hasattr(value, "item") else value
+
+
+class ResultsWriter:
+    """Write rows of results to a file, in bulk.
+
+    Rows are dictionaries with keys among the column names; they are kept in
+    memory and written every `buffer_rows` rows and when the writer is closed.
+
+    Arguments
+    ---------
+    out_file: path to output file
+    columns: list of pairs (column name, type), type among 'str', 'int', 'float'
+    out_format: 'tsv', 'jsonl' or 'parquet'
+    header (bool): write the column names as first line (tsv only)
+    append (bool): append to the output file if it exists (tsv and jsonl only)
+    sample: if not None, value of an additional first column 'Sample'
+    with_sample (bool): add the 'Sample' column even if sample is None (see set_sample)
+    buffer_rows: number of rows kept in memory before being written
+    """
+
+    def __init__(
+        self,
+        out_file,
+        columns,
+        out_format="tsv",
+        header=True,
+        append=False,
+        sample=None,
+        with_sample=False,
+        buffer_rows=10000,
+    ):
+        if out_format not in OUT_FORMATS:
+            process_error(f"Unknown output format {out_format}")
+        self.out_format = out_format
+        self.with_sample = with_sample or sample is not None
+        self.columns = [("Sample", "str")] + columns if self.with_sample else columns
+        self.sample = sample
+        self.buffer_rows = buffer_rows
+        self.rows = []
+        self.parquet_writer = None
+        if out_format == "parquet":
+            if append and os.path.isfile(out_file):
+                process_error(f"Cannot append to parquet file {out_file}")
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError:
+                process_error("Parquet output requires the pyarrow package")
+            pa_types = {"str": pa.string(), "int": pa.int64(), "float": pa.float64()}
+            self.schema = pa.schema(
+                [(name, pa_types[col_type]) for name, col_type in self.columns],
+            )
+            self.parquet_writer = pq.ParquetWriter(out_file, self.schema)
+            return
+        write_header = header and out_format == "tsv"
+        if append and os.path.isfile(out_file) and os.path.getsize(out_file) > 0:
+            write_header = False
+        self.out = open(out_file, "a" if append else "w")
+        if write_header:
+            self.out.write("\t".join(name for name, _ in self.columns) + "\n")
+
+    def set_sample(self, sample):
+        """Change the value of the 'Sample' column for the next rows."""
+        self.sample = sample
+
+    def write(self, row, tsv_order=None):
+        """Add a row (dictionary: Key: column name, Value: value).
+
+        tsv_order: if not None, column names in the order in which the values
+        of the row are written in a tsv file (default: order of the columns)
+        """
+        if self.with_sample:
+            row = {"Sample": self.sample, **row}
+            if tsv_order is not None:
+                tsv_order = ["Sample"] + tsv_order
+        self.rows.append((row, tsv_order))
+        if len(self.rows) >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows, and flush them to disk (tsv and jsonl)."""
+        if len(self.rows) == 0:
+            return
+        if self.out_format == "tsv":
+            # Missing trailing values are omitted, missing values inside a row are written as None
+            lines = []
+            column_names = [name for name, _ in self.columns]
+            for row, tsv_order in self.rows:
+                names = column_names if tsv_order is None else tsv_order
+                values = [row.get(name) for name in names]
+                while len(values) > 0 and values[-1] is None and names[len(values) - 1] not in row:
+                    values.pop()
+                lines.append("\t".join(str(value) for value in values) + "\n")
+            self.out.write("".join(lines))
+            self.out.flush()
+        elif self.out_format == "jsonl":
+            self.out.write(
+                "".join(
+                    json.dumps({key: _to_builtin(value) for key, value in row.items()}) + "\n"
+                    for row, _ in self.rows
+                ),
+            )
+            self.out.flush()
+        else:
+            import pyarrow as pa
+
+            str_columns = {name for name, col_type in self.columns if col_type == "str"}
+            records = [
+                {
+                    key: str(value) if key in str_columns and value is not None else _to_builtin(value)
+                    for key, value in row.items()
+                }
+                for row, _ in self.rows
+            ]
+            self.parquet_writer.write_table(
+                pa.Table.from_pylist(records, schema=self.schema),
+            )
+        self.rows = []
+
+    def close(self):
+        """Write the buffered rows and close the output file."""
+        self.flush()
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+        else:
+            self.out.close()
@@ -0,0 +1,86 @@
+"""Streaming of multi-sample plasmid bins files."""
+
+import pandas as pd
+
+from log_errors_utils import process_error
+
+BINS_COLUMNS = ["plasmid", "contig", "contig_len"]
+
+
+def iter_samples(bins_file, sample_col, chunksize):
+    """Iterate over the samples of a multi-sample plasmid bins file.
+
+    The file is read by chunks of rows and each sample is returned as soon as
+    all its rows have been read, so the rows of a sample must be contiguous,
+    and samples must be sorted (see iter_sample_pairs).
+
+    Arguments
+    ---------
+    bins_file: path to input file, with a column sample_col in addition to the bins columns
+    sample_col: name of the sample column
+    chunksize: number of rows read at a time
+
+    Returns
+    -------
+    iterator of pairs (sample (str), DataFrame of the rows of the sample)
+    """
+    current_sample, current_rows = None, []
+    for chunk in pd.read_csv(
+        bins_file,
+        sep="\t",
+        dtype={sample_col: str},
+        chunksize=chunksize,
+    ):
+        if sample_col not in chunk.columns:
+            process_error(f"{bins_file}: missing sample column {sample_col}")
+        samples = chunk[sample_col]
+        runs = (samples != samples.shift()).cumsum()
+        for _, run in chunk.groupby(runs, sort=False):
+            sample = run[sample_col].iat[0]
+            if sample != current_sample:
+                if current_sample is not None:
+                    if sample < current_sample:
+                        process_error(
+                            f"{bins_file}: sample {sample} after sample {current_sample},"
+                            " rows of a sample must be contiguous and samples sorted",
+                        )
+                    yield current_sample, pd.concat(current_rows)
+                current_sample, current_rows = sample, []
+            current_rows.append(run)
+    if current_sample is not None:
+        yield current_sample, pd.concat(current_rows)
+
+
+def iter_sample_pairs(left_file, right_file, sample_col, chunksize):
+    """Iterate over the samples of two multi-sample plasmid bins files.
+
+    Both files must list their samples in increasing order of sample names
+    (compared as strings), so that they are read in step and only the
+    current sample of each file is kept in memory. Samples are returned in
+    increasing order; a sample missing from one file gets an empty set of
+    bins on that side.
+
+    Arguments
+    ---------
+    left_file, right_file: paths to input files
+    sample_col: name of the sample column
+    chunksize: number of rows read at a time
+
+    Returns
+    -------
+    iterator of triples (sample (str), DataFrame of left rows, DataFrame of right rows)
+    """
+    right_samples = iter_samples(right_file, sample_col, chunksize)
+    right_sample, right_df = next(right_samples, (None, None))
+    for sample, left_df in iter_samples(left_file, sample_col, chunksize):
+        while right_sample is not None and right_sample < sample:
+            yield right_sample, pd.DataFrame(columns=BINS_COLUMNS), right_df
+            right_sample, right_df = next(right_samples, (None, None))
+        if right_sample == sample:
+            yield sample, left_df, right_df
+            right_sample, right_df = next(right_samples, (None, None))
+        else:
+            yield sample, left_df, pd.DataFrame(columns=BINS_COLUMNS)
+    while right_sample is not None:
+        yield right_sample, pd.DataFrame(columns=BINS_COLUMNS), right_df
+        right_sample, right_df = next(right_samples, (None, None))
@@ -0,0 +1,80 @@
+"""Per-sample states of incremental runs, stored in a SQLite file."""
+
+import hashlib
+import json
+import pickle
+import sqlite3
+import uuid
+
+from log_errors_utils import process_exception
+
+STATES_TABLE = """CREATE TABLE IF NOT EXISTS sample_states (
+    mode TEXT NOT NULL,
+    sample TEXT NOT NULL,
+    run TEXT NOT NULL,
+    state BLOB NOT NULL,
+    PRIMARY KEY (mode, sample)
+)"""
+
+
+def digest(value):
+    """Digest (hexadecimal str) of a value built from str, int and tuples/lists."""
+    return hashlib.blake2b(repr(value).encode(), digest_size=16).hexdigest()
+
+
+class StateStore:
+    """States of the samples of an incremental run.
+
+    The state of a sample is loaded when the sample is processed and saved
+    (committed) right after, so only the state of the current sample is kept
+    in memory and an interrupted run keeps the states of the samples already
+    processed. States are keyed by mode and sample, so evaluation and
+    comparison runs, and runs on different samples, can share a state file.
+
+    Arguments
+    ---------
+    state_file: path to SQLite file, created if missing
+    mode: mode (str) of the run, eval or comp
+    """
+
+    def __init__(self, state_file, mode):
+        self.state_file = state_file
+        self.mode = mode
+        self.run = uuid.uuid4().hex
+        try:
+            self.conn = sqlite3.connect(state_file, timeout=60)
+            self.conn.execute(STATES_TABLE)
+            self.conn.commit()
+        except sqlite3.Error as e:
+            process_exception(f"STATE\t{state_file}: {e}")
+
+    def load(self, sample):
+        """State (dictionary) of a sample (str or None) saved by a previous run, empty if none."""
+        row = self.conn.execute(
+            "SELECT state FROM sample_states WHERE mode = ? AND sample = ?",
+            (self.mode, json.dumps(sample)),
+        ).fetchone()
+        return {} if row is None else pickle.loads(row[0])
+
+    def save(self, sample, state):
+        """Save the state (dictionary) of a sample (str or None)."""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO sample_states (mode, sample, run, state) VALUES (?, ?, ?, ?)",
+            (self.mode, json.dumps(sample), self.run, pickle.dumps(state)),
+        )
+        self.conn.commit()
+
+    def close(self, prune=False):
+        """Close the store.
+
+        If prune is set, the states of the same mode saved for samples not
+        processed by this run are discarded first (used by multi-sample runs,
+        which process every sample of their input).
+        """
+        if prune:
+            self.conn.execute(
+                "DELETE FROM sample_states WHERE mode = ? AND run != ?",
+                (self.mode, self.run),
+            )
+            self.conn.commit()
+        self.conn.close()